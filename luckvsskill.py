@@ -1,34 +1,63 @@
+from concurrent.futures import ProcessPoolExecutor
+import threading
+
 import numpy as np
-import matplotlib.pyplot as plt
 
 # Author: Michael Liang
 
-def run_multiple_experiments(m = 10):
+# Shared random generator (PCG64DXSM), faster than the legacy np.random functions
+rng = np.random.Generator(np.random.PCG64DXSM())
+
+# Per-thread scratch buffers reused by run_experiment
+_scratch = threading.local()
+
+def run_multiple_experiments(m = 10, workers = None, seed = None):
 	'''
 	Runs multiple experiments and aggregates the data.
 	Shows histogram of the "Lucked-out-Rate", which is a function of the number of people
 	who wouldn't have been selected if skill was the only factor.
+	Experiments are independent, so they are spread across worker processes, each with
+	its own random generator spawned from a common seed.
+
+	Parameters (keyword):
+		m (int) - Number of experiments to run
+		workers (int) - Number of worker processes; None uses every core, 1 runs in-process
+		seed (int) - Seed for reproducible runs; None draws fresh entropy
 	'''
-	pop, cut, score = run_experiment()
-	scores = [score]
-
-	for _ in range(m-1):
-		a, b, c = run_experiment()
-		pop = np.vstack((pop, a))
-		cut = np.vstack((cut, b))
-		scores.append(c)
+	if m < 1:
+		raise ValueError("m must be at least 1, got {}".format(m))
+	if workers is not None and workers < 1:
+		raise ValueError("workers must be None or at least 1, got {}".format(workers))
+
+	seeds = np.random.SeedSequence(seed).spawn(m)
+	if workers == 1:
+		results = [_run_seeded_experiment(s) for s in seeds]
+	else:
+		with ProcessPoolExecutor(max_workers = workers) as executor:
+			results = list(executor.map(_run_seeded_experiment, seeds))
+
+	pop = np.empty((m, 3))
+	cut = np.empty((m, 3))
+	scores = np.empty(m)
+	for i, result in enumerate(results):
+		pop[i], cut[i], scores[i] = result
 	
 	print("\n------------------------------------------------------")
 	print("For {} experiments:".format(m))
 	print("------------------------------------------------------")
+	pop_means = pop.mean(axis = 0)
+	cut_means = cut.mean(axis = 0)
 	print("  Whole Population:")
-	print("    Skill: {}".format(np.mean(pop[:,1])))
-	print("    Luck:  {}".format(np.mean(pop[:,2])))
+	print("    Skill: {}".format(pop_means[1]))
+	print("    Luck:  {}".format(pop_means[2]))
 	print("  Selected Top Population:")
-	print("    Skill: {}".format(np.mean(cut[:,1])))
-	print("    Luck:  {}".format(np.mean(cut[:,2])))
+	print("    Skill: {}".format(cut_means[1]))
+	print("    Luck:  {}".format(cut_means[2]))
 	print("------------------------------------------------------\n")
-	_, plt.hist(scores, bins = 'auto')
+
+	# Imported here so that using run_experiment alone doesn't pay for matplotlib
+	import matplotlib.pyplot as plt
+	plt.hist(scores, bins = 'auto')
 	plt.title("Histogram of Lucked Out Rate")
 	plt.show()
 
@@ -39,24 +68,26 @@ def run_experiment(n = 500000,
 	threshold = 0.0001,
 	tolerance = 0.01,
 	verbose = False,
-	report = False):
+	report = False,
+	generator = None):
 	'''
 	Runs a luck and skill experiment.
 	Generates 'n' people with a score for both their skill and luck separately pulled
 	from a normal (Gaussian) distribution with mean 'mu' and standard deviation 'sigma'.
 	Then, an aggregate score for each person is calculated from their skill and luck scores
 	using a weight vector according to the 'weight_skill' attribute.
-	Aggregates are sorted, and then the highest scores according to 'threshold' are identified.
+	Aggregates are partitioned, and then the highest scores according to 'threshold' are identified.
 	Both the values for the whole population and the threshold group are returned.
 
 	Parameters (keyword):
 		mu (float) - Mean of the normal distribution
 		sigma (float) - Standard deviation of the normal distribution
 		weight_skill (float) - The percentage weight of skill towards the aggregate score
-		threshold (float) - The percentage of the population accepted at the top
+		threshold (float) - The percentage of the population accepted at the top (at least one person)
 		tolerance (float) - Testing normal distribution according to tolerance
 		verbose (bool) - Set verbose to True to print additional details.
 		report (bool) - Set report to True to generate a brief report for each experiment.
+		generator (Generator) - Random generator to draw from; defaults to the shared 'rng'
 
 	Returns:
 		all_means (ndarray) - Means of the features for the whole population
@@ -64,38 +95,37 @@ def run_experiment(n = 500000,
 		lucked_out_rate (float) - Percentage of selected who wouldn't have been if only skill-based
 	'''
 
-	# Generate n people with normal distribution of skill
-	skill = np.random.normal(mu+0.4, sigma, n)
+	# Generate n people with normal distributions of skill and luck in one draw.
+	# Scores stay as standard normal draws: scaling by sigma and shifting by the
+	# means preserves their order, so only the final means are mapped back.
+	if generator is None:
+		generator = rng
+	z, aggregate = _scratch_buffers(n)
+	generator.standard_normal(out = z, dtype = np.float32)
+	skill_z, luck_z = z
+	locs = (mu+0.4, mu)
 	if verbose:
-		print("Check skill average close to mu:", np.allclose(mu, np.mean(skill), rtol=tolerance))
-		print("Check skill deviation close to sigma:", np.allclose(sigma,np.std(skill, ddof=1), rtol=tolerance))
+		_check_distribution("skill", skill_z, locs[0], mu, sigma, tolerance)
+		_check_distribution("luck", luck_z, locs[1], mu, sigma, tolerance)
 
-	# Generate n people with normal distribution of luck
-	luck = np.random.normal(mu, sigma, n)
-	if verbose:
-		print("Check luck average close to mu:", np.allclose(mu, np.mean(luck), rtol=tolerance))
-		print("Check luck deviation close to sigma:", np.allclose(sigma,np.std(luck, ddof=1), rtol=tolerance))
-
-
-	# Aggregate their skill/luck scores with weight_skilling
-	aggregate = weight_skill*skill + (1.0-weight_skill)*luck
+	# Aggregate their skill/luck scores with weight_skilling, in place
+	# (w*skill + (1-w)*luck == w*(skill-luck) + luck, with no temporaries)
+	np.subtract(skill_z, luck_z, out = aggregate)
+	aggregate *= weight_skill
+	aggregate += luck_z
 
-	# Stack the array for easy sorting and transpose into columns
-	all_data = np.stack((aggregate, skill, luck), axis = 0).T
-
-	# Sort the data along the aggregate column
-	sorted_data = all_data[all_data[:,0].argsort()]
+	# Partition out the top aggregate scores (at least one); a full sort isn't needed
+	cutoff = max(1, int(threshold*n))
+	agg_top = _top_indices(aggregate, cutoff)
 
 	# Extract and calculated mu for extracted group
-	cutoff = int(threshold*n)
-	cutoff_data = sorted_data[-cutoff:,:]
-	all_means = np.mean(all_data, axis = 0)
-	cutoff_means = np.mean(cutoff_data, axis = 0)
+	all_means = _feature_means(skill_z, luck_z, locs, sigma, weight_skill)
+	cutoff_means = _feature_means(skill_z[agg_top], luck_z[agg_top], locs, sigma, weight_skill)
 
-	# Extract comparison with skill isolated
-	skill_data = np.sort(all_data[:,1])[-cutoff:]
-	intersect_data = np.intersect1d(skill_data, cutoff_data[:,1])
-	lucked_out_rate = 1.0 - intersect_data.shape[0]/cutoff_data.shape[0]
+	# Compare against the group selected on skill alone, by index
+	skill_top = _top_indices(skill_z, cutoff)
+	overlap = np.intersect1d(agg_top, skill_top, assume_unique = True).size
+	lucked_out_rate = 1.0 - overlap/cutoff
 
 	# Print report to console if verbose:
 	if report:
@@ -108,13 +138,86 @@ def run_experiment(n = 500000,
 		print("Means (all):    score {}; skill {}; luck {}".format(*np.around(all_means*100, 2)))
 		print("Means (cutoff): score {}; skill {}; luck {}".format(*np.around(cutoff_means*100, 2)))
 		print("------------------------------------------------------")
-		print("Participants selected:", cutoff_data.shape[0])
-		print("Participants overlooked:", cutoff_data.shape[0]-intersect_data.shape[0])
+		print("Participants selected:", cutoff)
+		print("Participants overlooked:", cutoff-overlap)
 		print("------------------------------------------------------\n")
 
 	# Returns results
 	return all_means, cutoff_means, lucked_out_rate
 
+def _run_seeded_experiment(seed):
+	'''
+	Runs a default experiment with a generator built from 'seed' (a SeedSequence).
+	Defined at module level so it can be sent to worker processes.
+	'''
+	return run_experiment(generator = np.random.Generator(np.random.PCG64DXSM(seed)))
+
+def _scratch_buffers(n):
+	'''
+	Returns the (2, n) draw buffer and the n aggregate buffer used by run_experiment.
+	Kept per thread, so back-to-back experiments reuse the same memory instead of
+	allocating fresh n-sized arrays each time, while concurrent calls from different
+	threads never share a buffer. Single precision is plenty for the scores and
+	halves the memory traffic; statistics are accumulated in double.
+	'''
+	buffers = getattr(_scratch, "buffers", None)
+	if buffers is None or buffers[1].shape[0] != n:
+		buffers = (np.empty((2, n), dtype = np.float32), np.empty(n, dtype = np.float32))
+		_scratch.buffers = buffers
+	return buffers
+
+def _check_distribution(name, draws, loc, mu, sigma, tolerance):
+	'''
+	Prints whether the sample mean and deviation of the scores 'loc' + 'sigma'*'draws'
+	are within the relative 'tolerance' of 'mu' and 'sigma'. Only called when verbose,
+	so it costs nothing otherwise.
+	'''
+	# Sum and sum of squares give the mean and sample deviation without a
+	# separate centring pass over the data
+	n = draws.shape[0]
+	total = draws.sum(dtype = np.float64)
+	mean = loc + sigma*total/n
+	std = sigma*np.sqrt((np.einsum('i,i->', draws, draws, dtype = np.float64) - total*total/n)/(n-1))
+	print("Check {} average close to mu:".format(name), abs(mu-mean) <= tolerance*abs(mu))
+	print("Check {} deviation close to sigma:".format(name), abs(sigma-std) <= tolerance*abs(sigma))
+
+def _feature_means(skill_z, luck_z, locs, sigma, weight_skill):
+	'''
+	Returns the means of (aggregate, skill, luck) for a group, given its standard normal
+	skill and luck draws and the (skill, luck) distribution means 'locs'.
+	The aggregate is linear in skill and luck, so its mean is derived from theirs
+	rather than taking another pass over the aggregate scores.
+	'''
+	skill_mean = locs[0] + sigma*skill_z.mean(dtype = np.float64)
+	luck_mean = locs[1] + sigma*luck_z.mean(dtype = np.float64)
+	return np.array([weight_skill*skill_mean + (1.0-weight_skill)*luck_mean, skill_mean, luck_mean])
+
+def _top_indices(values, k, chunk = 65536):
+	'''
+	Returns the indices of the 'k' largest entries of 'values', in no particular order.
+	Works like a size-k min-heap, vectorised over blocks of 'chunk' entries: a block
+	is only merged into the running top group where it beats the current smallest
+	member, so for k much smaller than n nothing of size n is ever allocated.
+	'''
+	chunk = max(chunk, k)
+	top_idx = np.argpartition(values[:chunk], -k)[-k:]
+	top_vals = values[top_idx]
+	floor = top_vals.min()
+
+	for start in range(chunk, values.shape[0], chunk):
+		block = values[start:start+chunk]
+		hits = np.flatnonzero(block > floor)
+		if hits.size == 0:
+			continue
+		cand_idx = np.concatenate((top_idx, hits + start))
+		cand_vals = np.concatenate((top_vals, block[hits]))
+		keep = np.argpartition(cand_vals, -k)[-k:]
+		top_idx = cand_idx[keep]
+		top_vals = cand_vals[keep]
+		floor = top_vals.min()
+
+	return top_idx
+
 
 if __name__ == "__main__":
 	run_multiple_experiments(m = 10)